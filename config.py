@@ -61,6 +61,44 @@ class Config:
             },
             'character': {
                 'path': 'character.json'
+            },
+            'quota': {
+                'enabled': True,
+                'state_file': 'quota_state.json',
+                'save_interval': 30,
+                'user': {
+                    'burst': 4000,
+                    'refill_per_minute': 800
+                },
+                'channel': {
+                    'burst': 12000,
+                    'refill_per_minute': 2400
+                },
+                'guild': {
+                    'burst': 24000,
+                    'refill_per_minute': 4800
+                }
+            },
+            'load': {
+                'enabled': True,
+                'queue_depth_thresholds': [2, 4, 6, 8],
+                'latency_thresholds': [20, 40, 60, 90],
+                'error_rate_thresholds': [0.5, 0.65, 0.8, 0.9],
+                'max_queue_depth': 16,
+                'reduced_max_length': 300,
+                'trimmed_history': 4,
+                'fallback_model': '',
+                'latency_window': 120,
+                'recovery_interval': 30,
+                'decision_log': 'load_decisions.jsonl'
+            },
+            'diagnostics': {
+                'enabled': True,
+                'lag_interval': 0.5,
+                'lag_history': 600,
+                'slow_callback_threshold': 0.25,
+                'profile_interval': 0.005,
+                'max_profile_seconds': 60
             }
         }
     
@@ -87,6 +125,28 @@ class Config:
         """Get LLM configuration"""
         return self.config['llm']
     
+    def get_quota_config(self):
+        """Get quota configuration, filling in defaults for missing keys"""
+        return self._merge_defaults(self._default_config()['quota'], self.config.get('quota') or {})
+    
+    def get_load_config(self):
+        """Get load shedding configuration, filling in defaults for missing keys"""
+        return self._merge_defaults(self._default_config()['load'], self.config.get('load') or {})
+    
+    def get_diagnostics_config(self):
+        """Get diagnostics configuration, filling in defaults for missing keys"""
+        return self._merge_defaults(self._default_config()['diagnostics'], self.config.get('diagnostics') or {})
+    
+    def _merge_defaults(self, defaults, overrides):
+        """Recursively merge a config section over its defaults"""
+        merged = dict(defaults)
+        for key, value in overrides.items():
+            if isinstance(value, dict) and isinstance(merged.get(key), dict):
+                merged[key] = self._merge_defaults(merged[key], value)
+            else:
+                merged[key] = value
+        return merged
+    
     def get_character_config(self):
         """Get character configuration"""
         return self.character
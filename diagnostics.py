@@ -0,0 +1,157 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import traceback
+from collections import Counter, deque
+from typing import Dict
+
+class LoopLagMonitor:
+    def __init__(self, config):
+        self.config = config
+        self.diagnostics_config = config.get_diagnostics_config()
+        self.interval = self.diagnostics_config['lag_interval']
+        self.slow_callback_threshold = self.diagnostics_config['slow_callback_threshold']
+        self.samples = deque(maxlen=self.diagnostics_config['lag_history'])
+        self.max_lag = 0.0
+        self.slow_callbacks = 0
+        self.heartbeat = time.monotonic()
+        self.loop = None
+        self.loop_thread_id = None
+        self.task = None
+        self.watchdog = None
+        self.stopped = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def start(self) -> None:
+        """Start sampling lag on the running event loop and watching it for stalls"""
+        if self.running:
+            return
+
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.stopped.clear()
+        self.task = self.loop.create_task(self._sample_lag())
+        self.watchdog = threading.Thread(target=self._watch_loop, name="loop-watchdog", daemon=True)
+        self.watchdog.start()
+
+    def stop(self) -> None:
+        """Stop sampling and watching"""
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _sample_lag(self) -> None:
+        """Measure how late each sleep wakes up, which is how long the loop was busy"""
+        while True:
+            start = self.loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, self.loop.time() - start - self.interval)
+            self.samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            self.heartbeat = time.monotonic()
+
+    def _watch_loop(self) -> None:
+        """Log the event loop's stack whenever it stops responding for too long"""
+        check_interval = max(self.slow_callback_threshold / 2, 0.01)
+        reported_heartbeat = None
+
+        while not self.stopped.wait(check_interval):
+            heartbeat = self.heartbeat
+            blocked_for = time.monotonic() - heartbeat - self.interval
+            # Report each stall once, however long it lasts
+            if blocked_for < self.slow_callback_threshold or heartbeat == reported_heartbeat:
+                continue
+
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+
+            reported_heartbeat = heartbeat
+            self.slow_callbacks += 1
+            stack = ''.join(traceback.format_stack(frame))
+            print(f"Event loop blocked for more than {blocked_for:.3f}s. Stack of the loop thread:\n{stack}")
+
+    def get_stats(self) -> Dict[str, float]:
+        """Get lag statistics in seconds"""
+        samples = sorted(self.samples)
+        if not samples:
+            return {"current": 0.0, "average": 0.0, "p99": 0.0, "max": self.max_lag,
+                    "slow_callbacks": self.slow_callbacks}
+
+        return {
+            "current": self.samples[-1],
+            "average": sum(samples) / len(samples),
+            "p99": samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+            "max": self.max_lag,
+            "slow_callbacks": self.slow_callbacks
+        }
+
+def _frame_label(frame) -> str:
+    """Format a frame the way collapsed-stack tools expect (no semicolons)"""
+    code = frame.f_code
+    label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+    return label.replace(';', ':')
+
+def profile_stacks(duration: float, interval: float = 0.005) -> str:
+    """Sample every thread's stack for a number of seconds.
+
+    This blocks for the whole duration, so use run_profile() from the event
+    loop. The result is in collapsed-stack format ("thread;outer;...;inner
+    count" per line), ready for flamegraph.pl or speedscope.
+    """
+    own_thread = threading.get_ident()
+    counts = Counter()
+    deadline = time.monotonic() + duration
+
+    while time.monotonic() < deadline:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(thread_names.get(thread_id, f"thread-{thread_id}").replace(';', ':'))
+            counts[';'.join(reversed(stack))] += 1
+
+        time.sleep(interval)
+
+    return ''.join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+async def run_profile(duration: float, interval: float = 0.005) -> str:
+    """Run profile_stacks on a dedicated thread and wait for the result.
+
+    The default executor can be filled by hung backend calls, which is
+    exactly when a profile is most needed, so it isn't used here.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def set_result(result, error):
+        # The command may have been cancelled while profiling
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def profile():
+        try:
+            result = profile_stacks(duration, interval)
+        except Exception as e:
+            loop.call_soon_threadsafe(set_result, None, e)
+        else:
+            loop.call_soon_threadsafe(set_result, result, None)
+
+    threading.Thread(target=profile, name="profiler", daemon=True).start()
+    return await future
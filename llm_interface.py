@@ -37,48 +37,58 @@ class LLMInterface:
         if len(self.conversation_history[channel_id]) > 20:  # Arbitrary limit, adjust as needed
             self.conversation_history[channel_id] = self.conversation_history[channel_id][-20:]
     
-    def get_conversation_history(self, channel_id: str) -> List[Message]:
-        """Get conversation history for a channel"""
-        return self.conversation_history.get(channel_id, [])
+    def get_conversation_history(self, channel_id: str, limit: Optional[int] = None) -> List[Message]:
+        """Get conversation history for a channel, optionally only the most recent messages"""
+        history = self.conversation_history.get(channel_id, [])
+        if limit is not None:
+            history = history[-limit:] if limit > 0 else []
+        return history
     
-    def _build_ollama_payload(self, channel_id: str, user_message: str) -> Dict[str, Any]:
+    def _build_ollama_payload(self, channel_id: str, user_message: str, max_length: Optional[int] = None,
+                              model: Optional[str] = None, history_limit: Optional[int] = None) -> Dict[str, Any]:
         """Build payload for Ollama API"""
         system_prompt = self._get_system_prompt()
         
         messages = [Message("system", system_prompt)]
-        messages.extend(self.get_conversation_history(channel_id))
+        messages.extend(self.get_conversation_history(channel_id, history_limit))
         messages.append(Message("user", user_message))
         
         return {
-            "model": self.api_config['model'],
+            "model": model or self.api_config['model'],
             "messages": [msg.to_dict() for msg in messages],
             "stream": self.message_config['stream'],
             "options": {
                 "temperature": self.message_config['temperature'],
                 "top_p": self.message_config['top_p'],
-                "max_tokens": self.message_config['max_length']
+                "max_tokens": max_length or self.message_config['max_length']
             }
         }
     
-    def _build_koboldcpp_payload(self, channel_id: str, user_message: str) -> Dict[str, Any]:
+    def _build_koboldcpp_payload(self, channel_id: str, user_message: str, max_length: Optional[int] = None,
+                                 model: Optional[str] = None, history_limit: Optional[int] = None) -> Dict[str, Any]:
         """Build payload for Koboldcpp API (OpenAI-compatible)"""
         system_prompt = self._get_system_prompt()
         
         messages = [Message("system", system_prompt)]
-        messages.extend(self.get_conversation_history(channel_id))
+        messages.extend(self.get_conversation_history(channel_id, history_limit))
         messages.append(Message("user", user_message))
         
         return {
-            "model": self.api_config.get('koboldcpp_model', 'llama3'),
+            "model": model or self.api_config.get('koboldcpp_model', 'llama3'),
             "messages": [msg.to_dict() for msg in messages],
             "stream": self.message_config['stream'],
             "temperature": self.message_config['temperature'],
             "top_p": self.message_config['top_p'],
-            "max_tokens": self.message_config['max_length']
+            "max_tokens": max_length or self.message_config['max_length']
         }
     
-    def query_llm(self, channel_id: str, user_message: str) -> str:
-        """Query LLM API with user message and return response"""
+    def query_llm(self, channel_id: str, user_message: str, max_length: Optional[int] = None,
+                  model: Optional[str] = None, history_limit: Optional[int] = None) -> str:
+        """Query LLM API with user message and return response.
+
+        max_length, model and history_limit override the configured values
+        for this request only, which lets callers degrade a request under load.
+        """
         api_type = self.api_config.get('type', 'ollama')
         
         # Set API URL and headers based on the API type
@@ -93,7 +103,7 @@ class LLMInterface:
                     api_url += '/chat/completions'
             
             # Build Koboldcpp payload
-            payload = self._build_koboldcpp_payload(channel_id, user_message)
+            payload = self._build_koboldcpp_payload(channel_id, user_message, max_length, model, history_limit)
             
             # Set headers with API key if provided
             headers = {"Content-Type": "application/json"}
@@ -104,7 +114,7 @@ class LLMInterface:
             api_url = self.api_config['url']
             
             # Build Ollama payload
-            payload = self._build_ollama_payload(channel_id, user_message)
+            payload = self._build_ollama_payload(channel_id, user_message, max_length, model, history_limit)
             
             # Standard headers
             headers = {"Content-Type": "application/json"}
@@ -0,0 +1,196 @@
+import json
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+LEVEL_NAMES = ['normal', 'reduce_length', 'trim_context', 'fallback_model', 'shed_low_priority']
+
+# Weight given to the newest sample in the average response time and error rate
+LATENCY_SMOOTHING = 0.3
+
+class LoadDecision:
+    def __init__(self, allowed: bool, level: int, priority: str, max_length: Optional[int] = None,
+                 model: Optional[str] = None, history_limit: Optional[int] = None):
+        self.allowed = allowed
+        self.level = level
+        self.priority = priority
+        # None means use the configured value
+        self.max_length = max_length
+        self.model = model
+        self.history_limit = history_limit
+        self.started = None
+        self.finished = None
+        self.failed = False
+
+    def mark_started(self) -> None:
+        """Record that the backend query is being sent"""
+        self.started = time.monotonic()
+
+    def mark_finished(self, failed: bool = False) -> None:
+        """Record that the backend answered (or failed), so its response time can be measured"""
+        self.finished = time.monotonic()
+        self.failed = failed
+
+    def query_options(self) -> Dict[str, Any]:
+        """Get the keyword arguments to pass to LLMInterface.query_llm"""
+        return {
+            "max_length": self.max_length,
+            "model": self.model,
+            "history_limit": self.history_limit
+        }
+
+class LoadShedder:
+    def __init__(self, config):
+        self.config = config
+        self.load_config = config.get_load_config()
+        self.enabled = self.load_config['enabled']
+        self.queue_depth_thresholds = self.load_config['queue_depth_thresholds']
+        self.latency_thresholds = self.load_config['latency_thresholds']
+        self.error_rate_thresholds = self.load_config['error_rate_thresholds']
+        self.max_queue_depth = self.load_config['max_queue_depth']
+        self.decision_log = self.load_config['decision_log']
+        # One worker per request max_queue_depth lets in, so the measured
+        # queue depth is the backend concurrency that is actually allowed
+        self.executor = ThreadPoolExecutor(max_workers=max(1, self.max_queue_depth),
+                                           thread_name_prefix="llm-query")
+        self.in_flight = 0
+        self.avg_latency = None
+        self.error_rate = 0.0
+        self.last_latency_at = 0.0
+        self.level = 0
+        self.level_changed_at = time.monotonic()
+
+    def _level_for(self, value: float, thresholds) -> int:
+        """Get the number of thresholds a value has reached"""
+        return sum(1 for threshold in thresholds if value >= threshold)
+
+    def _target_level(self, now: float) -> int:
+        """Get the level the current load calls for"""
+        level = self._level_for(self.in_flight, self.queue_depth_thresholds)
+
+        # Stale response times say nothing about the current load
+        if self.avg_latency is not None and now - self.last_latency_at <= self.load_config['latency_window']:
+            level = max(level, self._level_for(self.avg_latency, self.latency_thresholds))
+            # Busy backends often fail fast instead of answering slowly
+            level = max(level, self._level_for(self.error_rate, self.error_rate_thresholds))
+
+        return min(level, len(LEVEL_NAMES) - 1)
+
+    def _update_level(self, now: float) -> int:
+        """Escalate straight to the target level, but recover one step per recovery interval"""
+        target = self._target_level(now)
+        new_level = self.level
+
+        if target > self.level:
+            new_level = target
+        elif target < self.level:
+            # Nothing calls this while idle, so catch up on every step that was due
+            interval = self.load_config['recovery_interval']
+            steps = int((now - self.level_changed_at) // interval) if interval > 0 else self.level
+            new_level = max(target, self.level - steps)
+
+        if new_level != self.level:
+            print(f"Load level changed from {LEVEL_NAMES[self.level]} to {LEVEL_NAMES[new_level]} "
+                  f"(in flight: {self.in_flight}, average latency: {self._format_latency()}, "
+                  f"error rate: {self.error_rate:.0%})")
+            self.level = new_level
+            self.level_changed_at = now
+
+        return self.level
+
+    def _format_latency(self) -> str:
+        if self.avg_latency is None:
+            return "n/a"
+        return f"{self.avg_latency:.1f}s"
+
+    def admit(self, priority: str = 'normal') -> LoadDecision:
+        """Decide how (and whether) to serve a request.
+
+        Admitted requests count towards the queue depth until complete() is
+        called with the returned decision.
+        """
+        if not self.enabled:
+            self.in_flight += 1
+            return LoadDecision(True, 0, priority)
+
+        level = self._update_level(time.monotonic())
+
+        if priority != 'high' and self.in_flight >= self.max_queue_depth:
+            decision = LoadDecision(False, level, priority)
+        elif priority == 'low' and level >= 4:
+            decision = LoadDecision(False, level, priority)
+        else:
+            decision = LoadDecision(True, level, priority)
+            if level >= 1:
+                decision.max_length = min(self.load_config['reduced_max_length'],
+                                          self.config.get_llm_config()['message']['max_length'])
+            if level >= 2:
+                decision.history_limit = self.load_config['trimmed_history']
+            if level >= 3 and self.load_config['fallback_model']:
+                decision.model = self.load_config['fallback_model']
+
+        if decision.allowed:
+            self.in_flight += 1
+
+        if decision.level > 0 or not decision.allowed:
+            self._log_decision(decision)
+
+        return decision
+
+    def complete(self, decision: LoadDecision) -> None:
+        """Mark an admitted request as done and record how long the backend took.
+
+        Call this exactly once for every admitted request, however it ends.
+        Only the time between mark_started() and mark_finished() is counted,
+        so waiting for quota or behind other messages in the same channel
+        doesn't look like a slow backend. Failed queries count towards both
+        the response time and the error rate.
+        """
+        if not decision.allowed:
+            return
+
+        self.in_flight = max(0, self.in_flight - 1)
+
+        if decision.started is not None and decision.finished is not None:
+            latency = decision.finished - decision.started
+            if self.avg_latency is None:
+                self.avg_latency = latency
+            else:
+                self.avg_latency = LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * self.avg_latency
+            failed = 1.0 if decision.failed else 0.0
+            self.error_rate = LATENCY_SMOOTHING * failed + (1 - LATENCY_SMOOTHING) * self.error_rate
+            self.last_latency_at = decision.finished
+
+    async def run_query(self, query_func, *args, **kwargs):
+        """Run a blocking backend query on the query executor"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(query_func, *args, **kwargs))
+
+    def shutdown(self) -> None:
+        """Stop the query executor without waiting for queries still running"""
+        self.executor.shutdown(wait=False)
+
+    def _log_decision(self, decision: LoadDecision) -> None:
+        """Append a degradation decision to the decision log"""
+        if not self.decision_log:
+            return
+
+        entry = {
+            "time": time.time(),
+            "level": LEVEL_NAMES[decision.level],
+            "allowed": decision.allowed,
+            "priority": decision.priority,
+            "in_flight": self.in_flight,
+            "avg_latency": self.avg_latency,
+            "error_rate": self.error_rate,
+            "max_length": decision.max_length,
+            "history_limit": decision.history_limit,
+            "model": decision.model
+        }
+        try:
+            with open(self.decision_log, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+        except Exception as e:
+            print(f"Error writing load decision log: {e}")
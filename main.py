@@ -1,5 +1,7 @@
 import os
+import io
 import asyncio
+import math
 import platform
 import ssl
 import discord
@@ -9,6 +11,9 @@ from typing import Optional
 
 from config import Config
 from llm_interface import LLMInterface, Message
+from quota import QuotaManager, estimate_tokens
+from load_shedding import LoadShedder
+from diagnostics import LoopLagMonitor, run_profile
 
 # SSL certificate workaround for macOS
 if platform.system() == 'Darwin':
@@ -40,6 +45,17 @@ bot = commands.Bot(command_prefix=config.get_command_prefix(), intents=intents)
 
 # Initialize LLM interface
 llm_interface = LLMInterface(config)
+channel_locks = {}  # channel_id -> asyncio.Lock
+
+# Initialize quota manager
+quota_manager = QuotaManager(config)
+
+# Initialize load shedder
+load_shedder = LoadShedder(config)
+
+# Initialize event loop diagnostics
+diagnostics_config = config.get_diagnostics_config()
+lag_monitor = LoopLagMonitor(config)
 
 @bot.event
 async def on_ready():
@@ -47,6 +63,10 @@ async def on_ready():
     print(f'Logged in as {bot.user.name} ({bot.user.id})')
     print('---')
     
+    # Start watching the event loop (on_ready can fire again after reconnects)
+    if diagnostics_config['enabled'] and not lag_monitor.running:
+        lag_monitor.start()
+    
     # Sync commands
     try:
         await bot.tree.sync()
@@ -96,6 +116,51 @@ def create_error_embed():
     )
     return embed
 
+def format_wait(seconds):
+    """Format a wait time in seconds for display"""
+    seconds = math.ceil(seconds)
+    if seconds < 60:
+        return f"{seconds} second{'s' if seconds != 1 else ''}"
+    minutes = math.ceil(seconds / 60)
+    return f"{minutes} minute{'s' if minutes != 1 else ''}"
+
+def create_quota_embed(reservation):
+    """Create an embed telling the user they have been throttled"""
+    scope_text = {
+        'user': "You've been talking to me a lot",
+        'channel': "This channel has been keeping me very busy",
+        'guild': "This server has been keeping me very busy"
+    }
+    embed = discord.Embed(
+        title="Slow Down",
+        description=f"{scope_text.get(reservation.scope, 'I have been very busy')}. "
+                    f"Please try again in {format_wait(reservation.retry_after)}.",
+        color=discord.Color.orange()
+    )
+    return embed
+
+def create_busy_embed():
+    """Create an embed telling the user the bot is too busy to answer"""
+    embed = discord.Embed(
+        title="Too Busy",
+        description="I'm swamped with messages right now. Please try again in a minute!",
+        color=discord.Color.orange()
+    )
+    return embed
+
+async def get_request_priority(message):
+    """Get the load shedding priority of a message"""
+    if await bot.is_owner(message.author):
+        return 'high'
+    
+    # Users who have already spent most of their quota are the first to be shed
+    if quota_manager.enabled:
+        remaining, burst = quota_manager.get_remaining('user', str(message.author.id))
+        if remaining < burst / 2:
+            return 'low'
+    
+    return 'normal'
+
 async def process_llm_query(message):
     """Process a message as an LLM query"""
     channel_id = str(message.channel.id)
@@ -112,39 +177,82 @@ async def process_llm_query(message):
         # If the message is empty after removing mentions, ignore it
         return
     
-    # Add typing indicator
-    async with message.channel.typing():
-        # Add user message to history
-        llm_interface.add_message(channel_id, Message("user", user_message))
-        
-        # Query LLM
-        response_text = llm_interface.query_llm(channel_id, user_message)
-        
-        # Check if it's an error message
-        if response_text.startswith("ERROR:"):
-            # Create and send error embed
-            embed = create_error_embed()
-            bot_message = await message.reply(embed=embed)
-            
-            # Don't store error responses in history
+    # Work out priority before this request is charged to the user's bucket
+    priority = await get_request_priority(message)
+    
+    # Reserve the maximum number of tokens this reply could generate. This happens
+    # before admission so throttled users always get the quota reply and never
+    # count towards the load
+    guild_id = str(message.guild.id) if message.guild else None
+    max_tokens = llm_interface.message_config['max_length']
+    reservation = quota_manager.acquire(str(message.author.id), channel_id, guild_id, max_tokens)
+    if not reservation.allowed:
+        await message.reply(embed=create_quota_embed(reservation))
+        return
+    
+    decision = None
+    generated_tokens = 0
+    try:
+        # Decide how to serve the request given the current backend load
+        decision = load_shedder.admit(priority)
+        if not decision.allowed:
+            await message.reply(embed=create_busy_embed())
             return
         
-        # Split message if too long (Discord has a 2000 character limit)
-        if len(response_text) > 2000:
-            chunks = [response_text[i:i+1990] for i in range(0, len(response_text), 1990)]
-            
-            # Send each chunk
-            for i, chunk in enumerate(chunks):
-                if i == 0:
-                    bot_message = await message.reply(chunk)
+        # Add typing indicator
+        async with message.channel.typing():
+            # Handle one request per channel at a time so history stays in order
+            async with channel_locks.setdefault(channel_id, asyncio.Lock()):
+                # Add user message to history
+                llm_interface.add_message(channel_id, Message("user", user_message))
+                
+                # Query LLM in a worker thread so other messages keep being handled
+                decision.mark_started()
+                try:
+                    response_text = await load_shedder.run_query(
+                        llm_interface.query_llm, channel_id, user_message, **decision.query_options()
+                    )
+                except Exception:
+                    decision.mark_finished(failed=True)
+                    raise
+                
+                # Failures count as load too, e.g. a busy backend answering 503
+                decision.mark_finished(failed=response_text.startswith("ERROR:"))
+                
+                # Check if it's an error message
+                if response_text.startswith("ERROR:"):
+                    # Create and send error embed
+                    embed = create_error_embed()
+                    bot_message = await message.reply(embed=embed)
+                    
+                    # Don't store error responses in history
+                    return
+                
+                generated_tokens = estimate_tokens(response_text)
+                
+                # Split message if too long (Discord has a 2000 character limit)
+                if len(response_text) > 2000:
+                    chunks = [response_text[i:i+1990] for i in range(0, len(response_text), 1990)]
+                    
+                    # Send each chunk
+                    for i, chunk in enumerate(chunks):
+                        if i == 0:
+                            bot_message = await message.reply(chunk)
+                        else:
+                            bot_message = await message.channel.send(chunk)
                 else:
-                    bot_message = await message.channel.send(chunk)
-        else:
-            # Send response
-            bot_message = await message.reply(response_text)
+                    # Send response
+                    bot_message = await message.reply(response_text)
+                
+                # Add bot response to history
+                llm_interface.add_message(channel_id, Message("assistant", response_text))
+    finally:
+        # Refund whatever wasn't generated, which is everything if no reply was produced
+        quota_manager.settle(reservation, generated_tokens)
         
-        # Add bot response to history
-        llm_interface.add_message(channel_id, Message("assistant", response_text))
+        # Release the admission however the request ended, or the queue depth leaks
+        if decision is not None:
+            load_shedder.complete(decision)
 
 @bot.tree.command(name="reset", description="Reset the conversation history with the bot")
 async def reset_command(interaction: discord.Interaction):
@@ -153,6 +261,32 @@ async def reset_command(interaction: discord.Interaction):
     llm_interface.reset_conversation(channel_id)
     await interaction.response.send_message("Conversation history has been reset.", ephemeral=True)
 
+@bot.tree.command(name="quota", description="Check how much you can still chat with the bot")
+async def quota_command(interaction: discord.Interaction):
+    """Slash command to show remaining quota"""
+    if not quota_manager.enabled:
+        await interaction.response.send_message("Quotas are not enabled.", ephemeral=True)
+        return
+    
+    embed = discord.Embed(
+        title="Quota",
+        description="Remaining tokens I can generate for you right now.",
+        color=discord.Color.blue()
+    )
+    
+    scopes = [
+        ("You", 'user', str(interaction.user.id)),
+        ("This channel", 'channel', str(interaction.channel_id))
+    ]
+    if interaction.guild_id:
+        scopes.append(("This server", 'guild', str(interaction.guild_id)))
+    
+    for name, scope, scope_id in scopes:
+        remaining, burst = quota_manager.get_remaining(scope, scope_id)
+        embed.add_field(name=name, value=f"{int(remaining)} / {int(burst)}", inline=True)
+    
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 @bot.tree.command(name="help", description="Get help with using the LLM bot")
 async def help_command(interaction: discord.Interaction):
     """Slash command to show help information"""
@@ -171,6 +305,7 @@ async def help_command(interaction: discord.Interaction):
     embed.add_field(
         name="Commands",
         value=f"`/reset` - Reset the conversation history\n"
+              f"`/quota` - Check your remaining quota\n"
               f"`/help` - Show this help message",
         inline=False
     )
@@ -183,9 +318,53 @@ async def ping_command(ctx):
     latency = round(bot.latency * 1000)
     await ctx.send(f"Pong! Latency: {latency}ms")
 
+@bot.command(name="lag")
+@commands.is_owner()
+async def lag_command(ctx):
+    """Owner-only command to show event loop lag statistics"""
+    if not lag_monitor.running:
+        await ctx.send("Event loop monitoring is not enabled.")
+        return
+    
+    stats = lag_monitor.get_stats()
+    await ctx.send(
+        f"Event loop lag - current: {stats['current'] * 1000:.1f}ms, "
+        f"average: {stats['average'] * 1000:.1f}ms, "
+        f"p99: {stats['p99'] * 1000:.1f}ms, "
+        f"max: {stats['max'] * 1000:.1f}ms, "
+        f"slow callbacks: {stats['slow_callbacks']}\n"
+        f"Requests in flight: {load_shedder.in_flight}"
+    )
+
+@bot.command(name="profile")
+@commands.is_owner()
+async def profile_command(ctx, seconds: float = 10.0):
+    """Owner-only command to profile the bot and upload a collapsed-stack file"""
+    seconds = max(0.1, min(seconds, diagnostics_config['max_profile_seconds']))
+    await ctx.send(f"Profiling for {seconds:g} seconds...")
+    
+    # Sample from a dedicated thread so hung backend calls can't hold the profile up
+    collapsed = await run_profile(seconds, diagnostics_config['profile_interval'])
+    if not collapsed:
+        await ctx.send("No samples were collected.")
+        return
+    
+    profile_file = discord.File(io.BytesIO(collapsed.encode('utf-8')), filename="profile.collapsed")
+    await ctx.send("Profile complete. Open it with flamegraph.pl or speedscope.", file=profile_file)
+
 if __name__ == "__main__":
     token = config.get_discord_token()
     if not token:
         print("Error: No Discord token provided in config or .env file")
     else:
-        bot.run(token) 
\ No newline at end of file
+        try:
+            bot.run(token)
+        finally:
+            # Persist quota state so restarts don't reset everyone's buckets
+            quota_manager.save_state()
+            
+            # Stop the watchdog thread before the interpreter exits
+            lag_monitor.stop()
+            
+            # Don't wait for backend queries that may never return
+            load_shedder.shutdown() 
\ No newline at end of file
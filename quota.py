@@ -0,0 +1,196 @@
+import os
+import json
+import math
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Rough characters-per-token ratio used to estimate generated tokens
+CHARS_PER_TOKEN = 4
+
+SCOPES = ('user', 'channel', 'guild')
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens in a piece of text"""
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_rate: float, tokens: Optional[float] = None, last_refill: Optional[float] = None):
+        self.capacity = capacity
+        self.refill_rate = refill_rate  # tokens per second
+        self.tokens = capacity if tokens is None else min(tokens, capacity)
+        self.last_refill = time.time() if last_refill is None else last_refill
+
+    def refill(self, now: float) -> None:
+        """Add the tokens accrued since the last refill"""
+        elapsed = max(0.0, now - self.last_refill)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_rate)
+        self.last_refill = now
+
+    def retry_after(self, amount: float) -> float:
+        """Seconds until the bucket holds at least the given amount"""
+        # Requests larger than the bucket can only ever wait for a full bucket
+        needed = min(amount, self.capacity) - self.tokens
+        if needed <= 0:
+            return 0.0
+        if self.refill_rate <= 0:
+            return math.inf
+        return needed / self.refill_rate
+
+    def consume(self, amount: float) -> None:
+        """Remove tokens from the bucket"""
+        self.tokens -= amount
+
+    def refund(self, amount: float) -> None:
+        """Return unused tokens to the bucket"""
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def is_full(self) -> bool:
+        return self.tokens >= self.capacity
+
+    def to_dict(self) -> Dict[str, float]:
+        return {"tokens": self.tokens, "last_refill": self.last_refill}
+
+class Reservation:
+    def __init__(self, allowed: bool, keys: List[str], amount: int, retry_after: float = 0.0, scope: Optional[str] = None):
+        self.allowed = allowed
+        self.keys = keys  # bucket keys charged for this request
+        self.amount = amount  # tokens reserved up front
+        self.retry_after = retry_after
+        self.scope = scope  # scope that rejected the request, if any
+
+class QuotaManager:
+    def __init__(self, config):
+        self.config = config
+        self.quota_config = config.get_quota_config()
+        self.enabled = self.quota_config['enabled']
+        self.state_file = self.quota_config['state_file']
+        self.save_interval = self.quota_config['save_interval']
+        self.buckets = {}  # "scope:id" -> TokenBucket
+        self.dirty = False
+        self.last_save = time.time()
+        self._load_state()
+
+    def _bucket_settings(self, scope: str) -> Tuple[float, float]:
+        """Get (capacity, refill rate per second) for a scope"""
+        settings = self.quota_config[scope]
+        return settings['burst'], settings['refill_per_minute'] / 60.0
+
+    def _get_bucket(self, key: str, now: float) -> TokenBucket:
+        """Get the bucket for a key, creating a full one if needed"""
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            capacity, refill_rate = self._bucket_settings(key.split(':', 1)[0])
+            bucket = TokenBucket(capacity, refill_rate, last_refill=now)
+            self.buckets[key] = bucket
+        bucket.refill(now)
+        return bucket
+
+    def _keys_for(self, user_id: str, channel_id: str, guild_id: Optional[str]) -> List[str]:
+        keys = [f"user:{user_id}", f"channel:{channel_id}"]
+        # Direct messages have no guild
+        if guild_id is not None:
+            keys.append(f"guild:{guild_id}")
+        return keys
+
+    def acquire(self, user_id: str, channel_id: str, guild_id: Optional[str], amount: int) -> Reservation:
+        """Reserve tokens from the user, channel and guild buckets.
+
+        The request is only charged if every bucket can afford it, so a
+        rejection by one scope never drains the others.
+        """
+        keys = self._keys_for(user_id, channel_id, guild_id)
+        if not self.enabled:
+            return Reservation(True, [], 0)
+
+        now = time.time()
+        buckets = [self._get_bucket(key, now) for key in keys]
+
+        # Find the scope that would keep the user waiting the longest
+        retry_after = 0.0
+        scope = None
+        for key, bucket in zip(keys, buckets):
+            wait = bucket.retry_after(amount)
+            if wait > retry_after:
+                retry_after = wait
+                scope = key.split(':', 1)[0]
+
+        if scope is not None:
+            return Reservation(False, keys, 0, retry_after, scope)
+
+        for bucket in buckets:
+            bucket.consume(amount)
+        self._mark_dirty(now)
+        return Reservation(True, keys, amount)
+
+    def settle(self, reservation: Reservation, used: int) -> None:
+        """Refund the unused part of a reservation"""
+        if not reservation.allowed or not reservation.keys:
+            return
+
+        now = time.time()
+        unused = max(0, reservation.amount - used)
+        for key in reservation.keys:
+            self._get_bucket(key, now).refund(unused)
+        self._mark_dirty(now)
+
+    def get_remaining(self, scope: str, scope_id: str) -> Tuple[float, float]:
+        """Get (remaining tokens, burst) for a bucket"""
+        bucket = self._get_bucket(f"{scope}:{scope_id}", time.time())
+        return bucket.tokens, bucket.capacity
+
+    def _mark_dirty(self, now: float) -> None:
+        self.dirty = True
+        if now - self.last_save >= self.save_interval:
+            self.save_state()
+
+    def _load_state(self) -> None:
+        """Load bucket state from the state file"""
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+
+            buckets = {}
+            for key, data in state['buckets'].items():
+                scope = key.split(':', 1)[0]
+                if scope not in SCOPES:
+                    continue
+                # Use current settings so config changes apply to saved buckets
+                capacity, refill_rate = self._bucket_settings(scope)
+                buckets[key] = TokenBucket(capacity, refill_rate, float(data['tokens']), float(data['last_refill']))
+        except Exception as e:
+            # A corrupt state file only costs everyone a fresh bucket
+            print(f"Error loading quota state: {e}")
+            return
+
+        self.buckets = buckets
+
+    def save_state(self) -> None:
+        """Write bucket state to the state file"""
+        if not self.state_file or not self.dirty:
+            return
+
+        now = time.time()
+        buckets = {}
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            # Full buckets are identical to fresh ones, so there's no need to keep them
+            if bucket.is_full():
+                del self.buckets[key]
+            else:
+                buckets[key] = bucket.to_dict()
+
+        state = {"buckets": buckets}
+        tmp_file = f"{self.state_file}.tmp"
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_file, self.state_file)
+            self.dirty = False
+        except Exception as e:
+            print(f"Error saving quota state: {e}")
+        self.last_save = now